@@ -9,3 +9,8 @@ db = SQLAlchemy(app)
 
 # Import the views file for routing.
 import views
+
+# Time PolicyAccounting and the views when profiling is enabled.
+if app.config.get('PROFILING'):
+    import profiling
+    profiling.install(app)
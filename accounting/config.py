@@ -1,3 +1,14 @@
 import os
 
 SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.abspath("accounting.sqlite")
+
+# Which invoices payments are applied to first: 'oldest' or 'newest'.
+PAYMENT_ALLOCATION_ORDER = 'oldest'
+
+# Profiling of PolicyAccounting and the views, off unless asked for.
+# See accounting/profiling.py.
+PROFILING = os.environ.get('ACCOUNTING_PROFILING') == '1'
+PROFILING_THRESHOLD_MS = 500
+PROFILING_SAMPLE_RATE = 0.0
+PROFILING_CAPTURE_CALLS = 1
+PROFILING_DIR = os.path.abspath("profiles")
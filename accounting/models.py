@@ -6,7 +6,8 @@ from accounting import db
 class Policy(db.Model):
     __tablename__ = 'policies'
 
-    __table_args__ = {}
+    __table_args__ = (db.Index('ix_policies_policy_number_effective_date', 'policy_number', 'effective_date'),
+                      {})
 
     #column definitions
     id = db.Column(u'id', db.INTEGER(), primary_key=True, nullable=False)
@@ -54,6 +55,10 @@ class Invoice(db.Model):
     cancel_date = db.Column(u'cancel_date', db.DATE(), nullable=False)
     amount_due = db.Column(u'amount_due', db.INTEGER(), nullable=False)
     deleted = db.Column(u'deleted', db.Boolean, default=False, server_default='0', nullable=False)
+    amount_paid = db.Column(u'amount_paid', db.INTEGER(), default=0, server_default='0', nullable=False)
+    amount_remaining = db.Column(u'amount_remaining', db.INTEGER(), nullable=False)
+    paid = db.Column(u'paid', db.Boolean, default=False, server_default='0', nullable=False)
+    paid_date = db.Column(u'paid_date', db.DATE(), nullable=True)
 
     def __init__(self, policy_id, bill_date, due_date, cancel_date, amount_due):
         self.policy_id = policy_id
@@ -61,6 +66,9 @@ class Invoice(db.Model):
         self.due_date = due_date
         self.cancel_date = cancel_date
         self.amount_due = amount_due
+        self.amount_paid = 0
+        self.amount_remaining = amount_due
+        self.paid = False
 
 
 class Payment(db.Model):
@@ -0,0 +1,286 @@
+#!/user/bin/env python2.7
+
+import cProfile
+import inspect
+import logging
+import os
+import random
+import signal
+import threading
+import time
+
+from collections import deque
+from datetime import datetime
+from functools import wraps
+
+"""
+#######################################################
+Opt-in profiling for PolicyAccounting and the Flask views.
+Set PROFILING in config.py (or ACCOUNTING_PROFILING=1) to turn it on.
+#######################################################
+"""
+
+# The profiler installed by install(), None while profiling is off.
+profiler = None
+
+
+class LatencyHistogram(object):
+
+    """
+    This class keeps the latest call durations (in milliseconds) of one
+    timed function and reports percentiles over them.
+    Attributes:
+        attr1 - samples (deque): The most recent durations, at most size of them.
+        attr2 - count (int): How many calls were recorded in total.
+    """
+    def __init__(self, size=1000):
+        self.samples = deque(maxlen=size)
+        self.count = 0
+        # Reentrant, since the report can be written from a signal handler
+        # interrupting add() on the same thread.
+        self.lock = threading.RLock()
+
+    def add(self, elapsed_ms):
+        with self.lock:
+            self.samples.append(elapsed_ms)
+            self.count += 1
+
+    def snapshot(self):
+        with self.lock:
+            return self.count, sorted(self.samples)
+
+    """
+    This method returns the duration below which pct percent of the
+    recorded calls fall.
+    """
+    def percentile(self, pct, samples=None):
+        if samples is None:
+            samples = self.snapshot()[1]
+        if not samples:
+            return 0.0
+
+        index = int(round(pct / 100.0 * (len(samples) - 1)))
+        return samples[index]
+
+    def summary(self):
+        count, samples = self.snapshot()
+        return {'count': count,
+                'p50': self.percentile(50, samples),
+                'p95': self.percentile(95, samples),
+                'p99': self.percentile(99, samples),
+                'max': samples[-1] if samples else 0.0}
+
+
+class Profiler(object):
+
+    """
+    This class times wrapped functions into latency histograms and runs
+    some calls under cProfile, dumping the stats into output_dir.
+    A call is captured when it is sampled (sample_rate), or when a capture
+    was armed, either for the next calls of a function that was slower than
+    threshold_ms or for the next calls of any function by a signal.
+    Captured calls are left out of the histograms, since cProfile slows them down.
+    Attributes:
+        attr1 - histograms (dict): LatencyHistogram by timed function name.
+        attr2 - threshold_ms (int): Calls slower than this arm a capture, None disables it.
+        attr3 - sample_rate (float): Fraction of calls that are always captured.
+        attr4 - capture_calls (int): How many calls one trigger captures.
+        attr5 - output_dir (str): Where .prof files and latency reports are written.
+    """
+    def __init__(self, threshold_ms=None, sample_rate=0.0, capture_calls=1,
+                 output_dir='profiles', histogram_size=1000):
+        self.histograms = {}
+        self.threshold_ms = threshold_ms
+        self.sample_rate = sample_rate
+        self.capture_calls = capture_calls
+        self.output_dir = output_dir
+        self.histogram_size = histogram_size
+        # Armed captures by function name, None meaning any function.
+        self.pending_captures = {}
+        self.lock = threading.RLock()
+        self.local = threading.local()
+
+    def record(self, name, elapsed_ms):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            with self.lock:
+                histogram = self.histograms.setdefault(name, LatencyHistogram(self.histogram_size))
+        histogram.add(elapsed_ms)
+
+    """
+    This method arms cProfile for the next calls of the function timed
+    under name, or of any timed function when no name is given.
+    """
+    def arm(self, name=None, calls=None):
+        with self.lock:
+            self.pending_captures[name] = self.pending_captures.get(name, 0) + (calls or self.capture_calls)
+
+    def _should_capture(self, name):
+        # Calls made from inside a captured call are already in its profile.
+        if getattr(self.local, 'capturing', False):
+            return False
+        if self.sample_rate and random.random() < self.sample_rate:
+            return True
+        if self.pending_captures:
+            with self.lock:
+                for key in (name, None):
+                    if self.pending_captures.get(key):
+                        self.pending_captures[key] -= 1
+                        return True
+        return False
+
+    """
+    This method returns func wrapped with a timer recording under name.
+    Failing to record or dump never changes what the call returns or raises.
+    """
+    def wrap(self, name, func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            profile = None
+            if self._should_capture(name):
+                profile = cProfile.Profile()
+                self.local.capturing = True
+                profile.enable()
+
+            start = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                elapsed_ms = (time.time() - start) * 1000
+                if profile:
+                    profile.disable()
+                    self.local.capturing = False
+                    try:
+                        self.dump_profile(name, profile)
+                    except Exception:
+                        logging.exception("Dumping the profile of {} failed.".format(name))
+                else:
+                    try:
+                        self.record(name, elapsed_ms)
+                        if self.threshold_ms is not None and elapsed_ms > self.threshold_ms:
+                            logging.warning("{} took {:.1f}ms, capturing a profile.".format(name, elapsed_ms))
+                            self.arm(name)
+                    except Exception:
+                        logging.exception("Timing {} failed.".format(name))
+
+        wrapper._profiler = self
+        return wrapper
+
+    def _is_wrapped(self, func):
+        return getattr(func, '_profiler', None) is self
+
+    """
+    This method times __init__ and every public method of cls, in place.
+    """
+    def instrument_class(self, cls):
+        for attr, value in cls.__dict__.items():
+            if attr.startswith('_') and attr != '__init__':
+                continue
+
+            name = "{}.{}".format(cls.__name__, attr)
+            if isinstance(value, classmethod):
+                if not self._is_wrapped(value.__func__):
+                    setattr(cls, attr, classmethod(self.wrap(name, value.__func__)))
+            elif inspect.isfunction(value) and not self._is_wrapped(value):
+                setattr(cls, attr, self.wrap(name, value))
+
+    """
+    This method times every view function registered on the Flask app.
+    """
+    def instrument_app(self, app):
+        for endpoint, view in app.view_functions.items():
+            if endpoint == 'static' or self._is_wrapped(view):
+                continue
+            app.view_functions[endpoint] = self.wrap("view.{}".format(endpoint), view)
+
+    """
+    This method times commits made through a (scoped) SQLAlchemy session.
+    """
+    def instrument_session(self, session):
+        if not self._is_wrapped(session.commit):
+            session.commit = self.wrap('session.commit', session.commit)
+
+    def _ensure_output_dir(self):
+        if not os.path.isdir(self.output_dir):
+            os.makedirs(self.output_dir)
+
+    def dump_profile(self, name, profile):
+        self._ensure_output_dir()
+        path = os.path.join(self.output_dir, "{}-{}.prof".format(
+            name, datetime.now().strftime('%Y%m%d-%H%M%S-%f')))
+        profile.dump_stats(path)
+        logging.info("Profile written to {}".format(path))
+        return path
+
+    """
+    This method returns one line of call count and latency percentiles
+    (in milliseconds) per timed function.
+    """
+    def report(self):
+        lines = ["{:<50} {:>8} {:>9} {:>9} {:>9} {:>9}".format(
+            'name', 'count', 'p50', 'p95', 'p99', 'max')]
+        with self.lock:
+            histograms = sorted(self.histograms.items())
+        for name, histogram in histograms:
+            summary = histogram.summary()
+            lines.append("{:<50} {:>8} {:>9.2f} {:>9.2f} {:>9.2f} {:>9.2f}".format(
+                name, summary['count'], summary['p50'], summary['p95'], summary['p99'], summary['max']))
+        return "\n".join(lines)
+
+    def write_report(self):
+        self._ensure_output_dir()
+        path = os.path.join(self.output_dir, "latency-{}.txt".format(
+            datetime.now().strftime('%Y%m%d-%H%M%S-%f')))
+        with open(path, 'w') as report_file:
+            report_file.write(self.report() + "\n")
+        logging.info("Latency report written to {}".format(path))
+        return path
+
+    """
+    This method makes the given signal write a latency report and arm a
+    capture for the next calls. It can only be done from the main thread.
+    """
+    def install_signal_handler(self, signum=getattr(signal, 'SIGUSR1', None)):
+        if signum is None:
+            return False
+
+        # Anything raised here would surface in whatever frame the main
+        # thread was running, so errors are only logged.
+        def handler(received, frame):
+            try:
+                self.write_report()
+                self.arm()
+            except Exception:
+                logging.exception("Writing the latency report failed.")
+
+        try:
+            signal.signal(signum, handler)
+        except ValueError:
+            logging.warning("Profiling signal handler can only be installed from the main thread.")
+            return False
+        return True
+
+
+"""
+This function turns profiling on for the app, using the PROFILING_*
+settings of its config unless a Profiler instance is given, and
+returns the profiler.
+"""
+def install(app, instance=None):
+    global profiler
+    from accounting import db
+    from utils import PolicyAccounting
+
+    if instance is not None:
+        profiler = instance
+    elif profiler is None:
+        profiler = Profiler(threshold_ms=app.config.get('PROFILING_THRESHOLD_MS'),
+                            sample_rate=app.config.get('PROFILING_SAMPLE_RATE', 0.0),
+                            capture_calls=app.config.get('PROFILING_CAPTURE_CALLS', 1),
+                            output_dir=app.config.get('PROFILING_DIR', 'profiles'))
+        profiler.install_signal_handler()
+
+    profiler.instrument_class(PolicyAccounting)
+    profiler.instrument_app(app)
+    profiler.instrument_session(db.session)
+    return profiler
@@ -1,11 +1,18 @@
 #!/user/bin/env python2.7
 
+import os
+import shutil
+import signal
+import tempfile
+import time
 import unittest
 from datetime import date
 
-from accounting import db
+import profiling
+from accounting import app, db
 from models import Contact, Invoice, Payment, Policy
-from utils import PolicyAccounting
+from profiling import LatencyHistogram, Profiler, install
+from utils import PolicyAccounting, renew_policies
 
 """
 #######################################################
@@ -304,3 +311,379 @@ class TestChangeBillingSchedules(unittest.TestCase):
         self.assertEquals(len(invoices), 2)
 
 
+class TestPaymentAllocation(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.test_agent = Contact('Test Agent', 'Agent')
+        cls.test_insured = Contact('Test Insured', 'Named Insured')
+        db.session.add(cls.test_agent)
+        db.session.add(cls.test_insured)
+        db.session.commit()
+
+        cls.policy = Policy('Test Policy', date(2015, 1, 1), 1200)
+        cls.policy.named_insured = cls.test_insured.id
+        cls.policy.agent = cls.test_agent.id
+        db.session.add(cls.policy)
+        db.session.commit()
+
+    @classmethod
+    def tearDownClass(cls):
+        db.session.delete(cls.test_insured)
+        db.session.delete(cls.test_agent)
+        db.session.delete(cls.policy)
+        db.session.commit()
+
+    def setUp(self):
+        self.payments = []
+
+    def tearDown(self):
+        for invoice in self.policy.invoices:
+            db.session.delete(invoice)
+        for payment in self.payments:
+            db.session.delete(payment)
+        db.session.commit()
+
+    def test_new_invoices_are_unpaid(self):
+        self.policy.billing_schedule = "Quarterly"
+        pa = PolicyAccounting(self.policy)
+        for invoice in self.policy.invoices:
+            self.assertFalse(invoice.paid)
+            self.assertEquals(invoice.amount_paid, 0)
+            self.assertEquals(invoice.amount_remaining, 300)
+
+    def test_payment_allocated_to_oldest_invoices_first(self):
+        self.policy.billing_schedule = "Quarterly"
+        pa = PolicyAccounting(self.policy)
+        self.payments.append(pa.make_payment(contact_id=self.policy.named_insured,
+                                             date_cursor=date(2015, 1, 1), amount=450))
+        invoices = Invoice.query.filter_by(policy_id=self.policy.id)\
+                                .order_by(Invoice.bill_date).all()
+        self.assertTrue(invoices[0].paid)
+        self.assertEquals(invoices[0].amount_remaining, 0)
+        self.assertFalse(invoices[1].paid)
+        self.assertEquals(invoices[1].amount_paid, 150)
+        self.assertEquals(invoices[1].amount_remaining, 150)
+        self.assertEquals(invoices[2].amount_paid, 0)
+
+    def test_payment_allocated_to_newest_invoices_first(self):
+        self.policy.billing_schedule = "Quarterly"
+        pa = PolicyAccounting(self.policy)
+        app.config['PAYMENT_ALLOCATION_ORDER'] = 'newest'
+        try:
+            self.payments.append(pa.make_payment(contact_id=self.policy.named_insured,
+                                                 date_cursor=date(2015, 1, 1), amount=300))
+        finally:
+            app.config['PAYMENT_ALLOCATION_ORDER'] = 'oldest'
+        invoices = Invoice.query.filter_by(policy_id=self.policy.id)\
+                                .order_by(Invoice.bill_date).all()
+        self.assertFalse(invoices[0].paid)
+        self.assertTrue(invoices[3].paid)
+
+    def test_unknown_allocation_order(self):
+        self.policy.billing_schedule = "Annual"
+        pa = PolicyAccounting(self.policy)
+        app.config['PAYMENT_ALLOCATION_ORDER'] = 'random'
+        try:
+            self.assertRaises(ValueError, pa.allocate_payments)
+        finally:
+            app.config['PAYMENT_ALLOCATION_ORDER'] = 'oldest'
+
+    def test_overpayment_is_left_unallocated(self):
+        self.policy.billing_schedule = "Annual"
+        pa = PolicyAccounting(self.policy)
+        self.payments.append(pa.make_payment(contact_id=self.policy.named_insured,
+                                             date_cursor=date(2015, 1, 1), amount=1500))
+        self.assertTrue(self.policy.invoices[0].paid)
+        self.assertEquals(pa.return_unallocated_amount(), 300)
+        self.assertEquals(pa.return_remaining_due(), 0)
+
+    def test_payments_carried_over_on_billing_schedule_change(self):
+        self.policy.billing_schedule = "Quarterly"
+        pa = PolicyAccounting(self.policy)
+        self.payments.append(pa.make_payment(contact_id=self.policy.named_insured,
+                                             date_cursor=date(2015, 1, 1), amount=300))
+        pa.change_billing_schedule("Monthly")
+        invoices = Invoice.query.filter_by(policy_id=self.policy.id)\
+                                .filter(Invoice.deleted.is_(False))\
+                                .order_by(Invoice.bill_date).all()
+        self.assertEquals([invoice.paid for invoice in invoices], [True] * 3 + [False] * 9)
+        self.assertEquals(pa.return_remaining_due(), 900)
+
+    def test_paid_invoice_not_cancellation_pending(self):
+        self.policy.billing_schedule = "Annual"
+        pa = PolicyAccounting(self.policy)
+        self.payments.append(pa.make_payment(contact_id=self.policy.named_insured,
+                                             date_cursor=date(2015, 1, 1), amount=1200))
+        self.assertEquals(pa.evaluate_cancellation_pending_due_to_non_pay(date(2015, 2, 15)), False)
+
+    def test_late_payment_does_not_undo_cancellation(self):
+        self.policy.billing_schedule = "Annual"
+        pa = PolicyAccounting(self.policy)
+        self.payments.append(pa.make_payment(contact_id=self.policy.named_insured,
+                                             date_cursor=date(2015, 3, 1), amount=1200))
+        self.assertEquals(self.policy.invoices[0].paid_date, date(2015, 3, 1))
+        self.assertEquals(pa.evaluate_cancellation_pending_due_to_non_pay(date(2015, 2, 10)), True)
+        self.assertEquals(pa.evaluate_cancellation_pending_due_to_non_pay(date(2015, 3, 1)), False)
+        self.assertTrue(pa.evaluate_cancel(date(2015, 2, 20)))
+
+    def test_backdated_payment_reallocated_in_date_order(self):
+        self.policy.billing_schedule = "Quarterly"
+        pa = PolicyAccounting(self.policy)
+        self.payments.append(pa.make_payment(contact_id=self.policy.named_insured,
+                                             date_cursor=date(2015, 4, 1), amount=300))
+        self.payments.append(pa.make_payment(contact_id=self.policy.named_insured,
+                                             date_cursor=date(2015, 1, 1), amount=300))
+        invoices = Invoice.query.filter_by(policy_id=self.policy.id)\
+                                .order_by(Invoice.bill_date).all()
+        self.assertEquals(invoices[0].paid_date, date(2015, 1, 1))
+        self.assertEquals(invoices[1].paid_date, date(2015, 4, 1))
+
+    def test_zero_amount_invoices_are_paid(self):
+        self.policy.billing_schedule = "Monthly"
+        self.policy.annual_premium = 10
+        try:
+            pa = PolicyAccounting(self.policy)
+            self.assertTrue(all(invoice.paid for invoice in self.policy.invoices))
+            self.assertFalse(pa.evaluate_cancel(date(2016, 6, 1)))
+        finally:
+            self.policy.annual_premium = 1200
+
+
+class TestPolicyRenewals(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.test_agent = Contact('Test Agent', 'Agent')
+        cls.test_insured = Contact('Test Insured', 'Named Insured')
+        db.session.add(cls.test_agent)
+        db.session.add(cls.test_insured)
+        db.session.commit()
+
+    @classmethod
+    def tearDownClass(cls):
+        db.session.delete(cls.test_insured)
+        db.session.delete(cls.test_agent)
+        db.session.commit()
+
+    def setUp(self):
+        self.policies = []
+        for policy_number in ('Test Policy A', 'Test Policy B'):
+            policy = Policy(policy_number, date(2010, 1, 1), 1200)
+            policy.billing_schedule = "Quarterly"
+            policy.named_insured = self.test_insured.id
+            policy.agent = self.test_agent.id
+            db.session.add(policy)
+            self.policies.append(policy)
+        db.session.commit()
+
+    def tearDown(self):
+        policies = Policy.query.filter(Policy.policy_number.in_(['Test Policy A', 'Test Policy B'])).all()
+        for policy in policies:
+            for invoice in policy.invoices:
+                db.session.delete(invoice)
+            db.session.delete(policy)
+        db.session.commit()
+
+    def test_no_renewal_before_lead_time(self):
+        self.assertEquals(renew_policies(date(2010, 11, 1), lead_days=30), 0)
+        self.assertEquals(self.policies[0].status, 'Active')
+
+    def test_renewal_creates_next_term(self):
+        self.assertEquals(renew_policies(date(2010, 12, 15), lead_days=30, batch_size=1), 2)
+        self.assertEquals(self.policies[0].status, 'Active')
+        renewal = Policy.query.filter_by(policy_number='Test Policy A',
+                                         effective_date=date(2011, 1, 1)).one()
+        self.assertEquals(renewal.status, 'Active')
+        self.assertEquals(renewal.billing_schedule, "Quarterly")
+        self.assertEquals(renewal.named_insured, self.test_insured.id)
+        self.assertEquals(renewal.agent, self.test_agent.id)
+        invoices = Invoice.query.filter_by(policy_id=renewal.id)\
+                                .order_by(Invoice.bill_date).all()
+        self.assertEquals([invoice.bill_date for invoice in invoices],
+                          [date(2011, 1, 1), date(2011, 4, 1), date(2011, 7, 1), date(2011, 10, 1)])
+        self.assertEquals([invoice.amount_remaining for invoice in invoices], [300] * 4)
+
+    def test_prior_term_expired_once_term_ends(self):
+        renew_policies(date(2010, 12, 15), lead_days=30)
+        self.assertEquals(renew_policies(date(2011, 1, 1), lead_days=30), 0)
+        self.assertEquals(self.policies[0].status, 'Expired')
+        self.assertEquals(self.policies[1].status, 'Expired')
+
+    def test_renewal_run_can_be_repeated(self):
+        renew_policies(date(2010, 12, 15), lead_days=30)
+        self.assertEquals(renew_policies(date(2010, 12, 15), lead_days=30), 0)
+        self.assertEquals(Policy.query.filter_by(policy_number='Test Policy A').count(), 2)
+
+    def test_renewal_within_grace_period(self):
+        self.assertEquals(renew_policies(date(2011, 1, 5), lead_days=30, grace_days=7), 2)
+        self.assertEquals(self.policies[0].status, 'Expired')
+        renewal = Policy.query.filter_by(policy_number='Test Policy A',
+                                         effective_date=date(2011, 1, 1)).one()
+        self.assertEquals(renewal.status, 'Active')
+
+    def test_lapsed_policy_expired_without_renewal(self):
+        self.assertEquals(renew_policies(date(2013, 6, 1), lead_days=30, grace_days=7), 0)
+        self.assertEquals(Policy.query.filter_by(policy_number='Test Policy A').count(), 1)
+        self.assertEquals(self.policies[0].status, 'Expired')
+        self.assertEquals(self.policies[1].status, 'Expired')
+
+
+class TestProfiling(unittest.TestCase):
+
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir)
+
+    def test_histogram_percentiles(self):
+        histogram = LatencyHistogram()
+        for elapsed_ms in range(1, 101):
+            histogram.add(elapsed_ms)
+        summary = histogram.summary()
+        self.assertEquals(summary['count'], 100)
+        self.assertEquals(summary['p50'], 51)
+        self.assertEquals(summary['p95'], 95)
+        self.assertEquals(summary['p99'], 99)
+        self.assertEquals(summary['max'], 100)
+
+    def test_histogram_keeps_latest_samples(self):
+        histogram = LatencyHistogram(size=10)
+        for elapsed_ms in range(100):
+            histogram.add(elapsed_ms)
+        self.assertEquals(histogram.count, 100)
+        self.assertEquals(len(histogram.samples), 10)
+        self.assertEquals(histogram.percentile(0), 90)
+
+    def test_instrument_class_times_public_methods(self):
+        class Timed(object):
+            def __init__(self, value):
+                self.value = value
+
+            def double(self):
+                return self.value * 2
+
+            @classmethod
+            def build(cls, value):
+                return cls(value)
+
+            def _private(self):
+                return self.value
+
+        profiler = Profiler(output_dir=self.output_dir)
+        profiler.instrument_class(Timed)
+        self.assertEquals(Timed.build(2).double(), 4)
+        self.assertEquals(Timed(3)._private(), 3)
+        self.assertEquals(sorted(profiler.histograms), ['Timed.__init__', 'Timed.build', 'Timed.double'])
+        self.assertEquals(profiler.histograms['Timed.__init__'].count, 2)
+
+    def test_slow_call_arms_capture(self):
+        profiler = Profiler(threshold_ms=-1, output_dir=self.output_dir)
+        double = profiler.wrap('double', lambda value: value * 2)
+        double(1)
+        self.assertEquals(os.listdir(self.output_dir), [])
+        double(2)
+        profiles = os.listdir(self.output_dir)
+        self.assertEquals(len(profiles), 1)
+        self.assertTrue(profiles[0].startswith('double-'))
+
+    def test_slow_call_captures_same_function(self):
+        profiler = Profiler(threshold_ms=50, output_dir=self.output_dir)
+        slow = profiler.wrap('slow', lambda: time.sleep(0.1))
+        fast = profiler.wrap('fast', lambda: None)
+        slow()
+        fast()
+        self.assertEquals(os.listdir(self.output_dir), [])
+        slow()
+        profiles = os.listdir(self.output_dir)
+        self.assertEquals(len(profiles), 1)
+        self.assertTrue(profiles[0].startswith('slow-'))
+
+    def test_write_report(self):
+        profiler = Profiler(output_dir=self.output_dir)
+        profiler.wrap('double', lambda value: value * 2)(1)
+        with open(profiler.write_report()) as report_file:
+            report = report_file.read()
+        self.assertTrue('double' in report)
+
+    def test_sampled_calls_are_captured(self):
+        profiler = Profiler(sample_rate=1.0, output_dir=self.output_dir)
+        double = profiler.wrap('double', lambda value: value * 2)
+        double(1)
+        double(2)
+        self.assertEquals(len(os.listdir(self.output_dir)), 2)
+        self.assertFalse('double' in profiler.histograms)
+
+    def test_profiling_errors_do_not_break_calls(self):
+        output_file = os.path.join(self.output_dir, 'not-a-dir')
+        open(output_file, 'w').close()
+        profiler = Profiler(sample_rate=1.0, output_dir=os.path.join(output_file, 'profiles'))
+        self.assertEquals(profiler.wrap('answer', lambda: 42)(), 42)
+        self.assertRaises(ZeroDivisionError, profiler.wrap('fail', lambda: 1 / 0))
+
+    def test_timing_kept_when_dump_fails(self):
+        output_file = os.path.join(self.output_dir, 'not-a-dir')
+        open(output_file, 'w').close()
+        profiler = Profiler(threshold_ms=-1, output_dir=os.path.join(output_file, 'profiles'))
+        answer = profiler.wrap('answer', lambda: 42)
+        self.assertEquals(answer(), 42)
+        self.assertEquals(answer(), 42)
+        self.assertEquals(answer(), 42)
+        self.assertEquals(profiler.histograms['answer'].count, 2)
+
+    def test_signal_writes_report_and_arms_capture(self):
+        profiler = Profiler(output_dir=self.output_dir)
+        previous = signal.getsignal(signal.SIGUSR1)
+        try:
+            self.assertTrue(profiler.install_signal_handler(signal.SIGUSR1))
+            os.kill(os.getpid(), signal.SIGUSR1)
+        finally:
+            signal.signal(signal.SIGUSR1, previous)
+        self.assertEquals(profiler.pending_captures, {None: 1})
+        self.assertEquals(len(os.listdir(self.output_dir)), 1)
+
+    def test_signal_handler_errors_are_logged(self):
+        output_file = os.path.join(self.output_dir, 'not-a-dir')
+        open(output_file, 'w').close()
+        profiler = Profiler(output_dir=os.path.join(output_file, 'profiles'))
+        logged = []
+        log_exception = profiling.logging.exception
+        previous = signal.getsignal(signal.SIGUSR1)
+        profiling.logging.exception = logged.append
+        try:
+            profiler.install_signal_handler(signal.SIGUSR1)
+            os.kill(os.getpid(), signal.SIGUSR1)
+        finally:
+            signal.signal(signal.SIGUSR1, previous)
+            profiling.logging.exception = log_exception
+        self.assertEquals(logged, ["Writing the latency report failed."])
+        self.assertEquals(profiler.pending_captures, {})
+
+    def test_install_times_policy_accounting_views_and_commits(self):
+        methods = dict(PolicyAccounting.__dict__)
+        views = dict(app.view_functions)
+        session_commit = db.session.__dict__.get('commit')
+        installed = profiling.profiler
+        profiler = Profiler(output_dir=self.output_dir)
+        try:
+            self.assertTrue(install(app, profiler) is profiler)
+            policy = Policy.query.filter_by(policy_number='Policy One').first()
+            PolicyAccounting(policy).return_account_balance(date(2015, 1, 1))
+            self.assertEquals(app.test_client().get('/').status_code, 200)
+            db.session.commit()
+        finally:
+            for attr, value in methods.items():
+                if attr.startswith('_') and attr != '__init__':
+                    continue
+                setattr(PolicyAccounting, attr, value)
+            app.view_functions.clear()
+            app.view_functions.update(views)
+            if session_commit is None:
+                del db.session.commit
+            else:
+                db.session.commit = session_commit
+            profiling.profiler = installed
+        for name in ('PolicyAccounting.__init__', 'PolicyAccounting.return_account_balance',
+                     'view.index', 'session.commit'):
+            self.assertTrue(name in profiler.histograms, name)
@@ -4,9 +4,9 @@ import logging
 
 from datetime import date, datetime
 from dateutil.relativedelta import relativedelta
-from sqlalchemy import and_
+from sqlalchemy import and_, exists, func, or_
 
-from accounting import db
+from accounting import app, db
 from models import Contact, Invoice, Payment, Policy
 
 """
@@ -23,13 +23,17 @@ class PolicyAccounting(object):
         attr1 - policy (Policy or int): This attribute can represent a policy object
                                or just a id from a policy.
         attr2 - billing_schedules (dict): Represents possible schedules for a policy.
+    Payments are applied to invoices in the order set by PAYMENT_ALLOCATION_ORDER
+    in config.py, either 'oldest' or 'newest' bill date first.
     """
+    billing_schedules = {'Annual': None, 'Two-Pay': 2, 'Semi-Annual': 3, 'Quarterly': 4, 'Monthly': 12}
+    allocation_orders = {'oldest': Invoice.bill_date.asc(), 'newest': Invoice.bill_date.desc()}
+
     def __init__(self, policy_id):
         if type(policy_id) is Policy:
             policy_id = policy_id.id
 
         self.policy = Policy.query.filter_by(id=policy_id).one()
-        self.billing_schedules = {'Annual': None, 'Two-Pay': 2, 'Semi-Annual': 3, 'Quarterly': 4, 'Monthly': 12}
 
         if not self.policy.invoices:
             self.make_invoices()
@@ -58,6 +62,89 @@ class PolicyAccounting(object):
 
         return due_now
 
+    """
+    This method returns what is still owed, as of now, on all the live
+    invoices of the policy, read straight from the allocated invoice amounts.
+    Use return_account_balance for the balance at a given date.
+    """
+    def return_remaining_due(self):
+        return db.session.query(func.coalesce(func.sum(Invoice.amount_remaining), 0))\
+                         .filter(Invoice.policy_id == self.policy.id)\
+                         .filter(Invoice.deleted.is_(False))\
+                         .scalar()
+
+    """
+    This method returns the part of the policy's payments that has not
+    been applied to any live invoice yet (e.g. an overpayment).
+    """
+    def return_unallocated_amount(self):
+        paid = db.session.query(func.coalesce(func.sum(Payment.amount_paid), 0))\
+                         .filter(Payment.policy_id == self.policy.id)\
+                         .scalar()
+        allocated = db.session.query(func.coalesce(func.sum(Invoice.amount_paid), 0))\
+                              .filter(Invoice.policy_id == self.policy.id)\
+                              .filter(Invoice.deleted.is_(False))\
+                              .scalar()
+        return paid - allocated
+
+    """
+    This method applies an amount paid on date_cursor to the unpaid
+    invoices of the policy, following PAYMENT_ALLOCATION_ORDER. Each invoice
+    stores its paid and remaining amounts and the date it was paid in full.
+    Without an amount, every payment of the policy is applied again in
+    transaction date order. It returns the amount left over once every
+    invoice is paid.
+    """
+    def allocate_payments(self, amount=None, date_cursor=None):
+        if not date_cursor:
+            date_cursor = datetime.now().date()
+
+        allocation_order = app.config.get('PAYMENT_ALLOCATION_ORDER', 'oldest')
+        if allocation_order not in self.allocation_orders:
+            raise ValueError("Unknown allocation order: {}".format(allocation_order))
+
+        # The session does not autoflush, so pending invoices and payments
+        # have to be written before they can be queried.
+        db.session.flush()
+        invoices = Invoice.query.filter_by(policy_id=self.policy.id)\
+                                .filter(Invoice.deleted.is_(False))\
+                                .order_by(self.allocation_orders[allocation_order])\
+                                .all()
+
+        if amount is None:
+            for invoice in invoices:
+                invoice.amount_paid = 0
+                invoice.amount_remaining = invoice.amount_due
+                invoice.paid = invoice.amount_remaining <= 0
+                invoice.paid_date = None
+
+            payments = Payment.query.filter_by(policy_id=self.policy.id)\
+                                    .order_by(Payment.transaction_date, Payment.id)\
+                                    .all()
+            left_over = 0
+            for payment in payments:
+                left_over += self._apply_amount(invoices, payment.amount_paid, payment.transaction_date)
+        else:
+            left_over = self._apply_amount(invoices, amount, date_cursor)
+
+        db.session.commit()
+        return left_over
+
+    def _apply_amount(self, invoices, amount, paid_date):
+        for invoice in invoices:
+            if amount <= 0:
+                break
+            if invoice.paid:
+                continue
+            applied = min(amount, invoice.amount_remaining)
+            invoice.amount_paid += applied
+            invoice.amount_remaining -= applied
+            invoice.paid = invoice.amount_remaining <= 0
+            if invoice.paid:
+                invoice.paid_date = paid_date
+            amount -= applied
+        return amount
+
     """
     This method creates a payment for a policy
     """
@@ -76,7 +163,17 @@ class PolicyAccounting(object):
                           amount,
                           date_cursor)
         db.session.add(payment)
-        db.session.commit()
+        db.session.flush()
+
+        # A backdated payment changes when the later invoices were paid,
+        # so everything is applied again in date order.
+        later_payment = Payment.query.filter_by(policy_id=self.policy.id)\
+                                     .filter(Payment.transaction_date > date_cursor)\
+                                     .first()
+        if later_payment:
+            self.allocate_payments()
+        else:
+            self.allocate_payments(amount, date_cursor)
         logging.info(" new payment was created")
 
         return payment
@@ -92,6 +189,9 @@ class PolicyAccounting(object):
             date_cursor = datetime.now().date()
 
         invoices = Invoice.query.filter_by(policy_id=self.policy.id)\
+                                .filter(Invoice.deleted.is_(False))\
+                                .filter(or_(Invoice.paid.is_(False),
+                                            Invoice.paid_date > date_cursor))\
                                 .filter(Invoice.due_date < date_cursor)\
                                 .all()
 
@@ -102,87 +202,103 @@ class PolicyAccounting(object):
 
     """
     This method realize a cancelation for invoices.
+    It returns True if an invoice was still unpaid on its cancel_date.
     """
     def evaluate_cancel(self, date_cursor=None):
         if not date_cursor:
             date_cursor = datetime.now().date()
 
-        invoices = Invoice.query.filter_by(policy_id=self.policy.id)\
-                                .filter(Invoice.cancel_date <= date_cursor)\
-                                .order_by(Invoice.bill_date)\
-                                .all()
+        invoice = Invoice.query.filter_by(policy_id=self.policy.id)\
+                               .filter(Invoice.deleted.is_(False))\
+                               .filter(or_(Invoice.paid.is_(False),
+                                           Invoice.paid_date > Invoice.cancel_date))\
+                               .filter(Invoice.cancel_date <= date_cursor)\
+                               .first()
 
-        for invoice in invoices:
-            if not self.return_account_balance(invoice.cancel_date):
-                continue
-            else:
-                print "THIS POLICY SHOULD HAVE CANCELED"
-                break
-        else:
-            print "THIS POLICY SHOULD NOT CANCEL"
+        if invoice:
+            print "THIS POLICY SHOULD HAVE CANCELED"
+            return True
+
+        print "THIS POLICY SHOULD NOT CANCEL"
+        return False
 
     """
     This method creates invoices according to policy's billing schedule
     """
     def make_invoices(self):
+        invoices = self.build_invoices(self.policy)
+
+        logging.info("Creating invoices...")
+        for invoice in invoices:
+            invoice.amount_remaining = invoice.amount_due
+            invoice.paid = invoice.amount_remaining <= 0
+            db.session.add(invoice)
+        # Payments already on the policy (e.g. before a schedule change)
+        # are carried over to the new invoices.
+        self.allocate_payments()
+        logging.info("{} invoices were created.".format(len(invoices)))
+
+    """
+    This method builds, without saving them, the invoices of a policy
+    according to its billing schedule. It only needs the policy, so
+    bulk jobs can use it without instantiating PolicyAccounting.
+    """
+    @classmethod
+    def build_invoices(cls, policy):
         invoices = []
-        first_invoice = Invoice(self.policy.id,
-                                self.policy.effective_date, #bill_date
-                                self.policy.effective_date + relativedelta(months=1), #due
-                                self.policy.effective_date + relativedelta(months=1, days=14), #cancel
-                                self.policy.annual_premium)
+        first_invoice = Invoice(policy.id,
+                                policy.effective_date, #bill_date
+                                policy.effective_date + relativedelta(months=1), #due
+                                policy.effective_date + relativedelta(months=1, days=14), #cancel
+                                policy.annual_premium)
         invoices.append(first_invoice)
 
-        if self.policy.billing_schedule == "Annual":
+        if policy.billing_schedule == "Annual":
             pass
-        elif self.policy.billing_schedule == "Two-Pay":
-            self.set_first_invoice_amount_due(first_invoice, self.policy.billing_schedule)
-            for i in range(1, self.billing_schedules.get(self.policy.billing_schedule)):
+        elif policy.billing_schedule == "Two-Pay":
+            cls.set_first_invoice_amount_due(first_invoice, policy.billing_schedule)
+            for i in range(1, cls.billing_schedules.get(policy.billing_schedule)):
                 months_after_eff_date = i*6
-                bill_date = self.policy.effective_date + relativedelta(months=months_after_eff_date)
-                invoice = Invoice(self.policy.id,
+                bill_date = policy.effective_date + relativedelta(months=months_after_eff_date)
+                invoice = Invoice(policy.id,
                                   bill_date,
                                   bill_date + relativedelta(months=1),
                                   bill_date + relativedelta(months=1, days=14),
-                                  self.policy.annual_premium / self.billing_schedules.get(self.policy.billing_schedule))
+                                  policy.annual_premium / cls.billing_schedules.get(policy.billing_schedule))
                 invoices.append(invoice)
-        elif self.policy.billing_schedule == "Quarterly":
-            self.set_first_invoice_amount_due(first_invoice, self.policy.billing_schedule)
-            for i in range(1, self.billing_schedules.get(self.policy.billing_schedule)):
+        elif policy.billing_schedule == "Quarterly":
+            cls.set_first_invoice_amount_due(first_invoice, policy.billing_schedule)
+            for i in range(1, cls.billing_schedules.get(policy.billing_schedule)):
                 months_after_eff_date = i*3
-                bill_date = self.policy.effective_date + relativedelta(months=months_after_eff_date)
-                invoice = Invoice(self.policy.id,
+                bill_date = policy.effective_date + relativedelta(months=months_after_eff_date)
+                invoice = Invoice(policy.id,
                                   bill_date,
                                   bill_date + relativedelta(months=1),
                                   bill_date + relativedelta(months=1, days=14),
-                                  self.policy.annual_premium / self.billing_schedules.get(self.policy.billing_schedule))
+                                  policy.annual_premium / cls.billing_schedules.get(policy.billing_schedule))
                 invoices.append(invoice)
-        elif self.policy.billing_schedule == "Monthly":
-            self.set_first_invoice_amount_due(first_invoice, self.policy.billing_schedule)
-            for i in range(1, self.billing_schedules.get(self.policy.billing_schedule)):
-                bill_date = self.policy.effective_date + relativedelta(months=i)
-                invoice = Invoice(self.policy.id,
+        elif policy.billing_schedule == "Monthly":
+            cls.set_first_invoice_amount_due(first_invoice, policy.billing_schedule)
+            for i in range(1, cls.billing_schedules.get(policy.billing_schedule)):
+                bill_date = policy.effective_date + relativedelta(months=i)
+                invoice = Invoice(policy.id,
                                   bill_date,
                                   bill_date + relativedelta(months=1),
                                   bill_date + relativedelta(months=1, days=14),
-                                  self.policy.annual_premium / self.billing_schedules.get(self.policy.billing_schedule))
+                                  policy.annual_premium / cls.billing_schedules.get(policy.billing_schedule))
                 invoices.append(invoice)
         else:
             print "You have chosen a bad billing schedule."
 
-        logging.info("Creating invoices...")
-        for invoice in invoices:
-            db.session.add(invoice)
-        db.session.commit()
-        logging.info("{} invoices were created.".format(len(invoices)))
+        return invoices
 
     """
     This method sets the first amount due for the first invoice from a policy.
     """
-    def set_first_invoice_amount_due(self, first_invoice, billing_schedule):
-        if billing_schedule in self.billing_schedules:
-            first_invoice.amount_due = first_invoice.amount_due / self.billing_schedules.get(
-                self.policy.billing_schedule)
+    @classmethod
+    def set_first_invoice_amount_due(cls, first_invoice, billing_schedule):
+        if billing_schedule in cls.billing_schedules:
+            first_invoice.amount_due = first_invoice.amount_due / cls.billing_schedules.get(billing_schedule)
         else:
             print "You have chosen a bad billing schedule."
 
@@ -207,6 +323,100 @@ class PolicyAccounting(object):
         self.make_invoices()
 
 
+"""
+This function applies the payments of every policy to its invoices
+again, which fills in the paid and remaining amounts of invoices that
+were created before they were tracked.
+"""
+def reallocate_all_payments():
+    policy_ids = [policy_id for (policy_id,) in db.session.query(Policy.id).all()]
+    for policy_id in policy_ids:
+        PolicyAccounting(policy_id).allocate_payments()
+    logging.info("Payments of {} policies reallocated.".format(len(policy_ids)))
+
+"""
+This function renews every active policy whose term ends within
+lead_days after date_cursor, or ended at most grace_days before it, and
+has no next term yet. Each renewal is a new Policy for the next year
+with the same number, insured, agent, schedule and premium, and its
+invoices are written with bulk inserts. Policies are read in id order,
+batch_size at a time, and each batch is its own transaction, so an
+interrupted run can simply be started again.
+Active policies whose term has ended are then marked Expired; the ones
+that lapsed before the grace period are expired without a renewal and
+logged, rather than billed for the terms they missed.
+It returns the number of policies renewed.
+"""
+def renew_policies(date_cursor=None, lead_days=30, grace_days=7, batch_size=500):
+    if not date_cursor:
+        date_cursor = datetime.now().date()
+
+    # A term ends one year after its effective date.
+    earliest = date_cursor - relativedelta(days=grace_days) - relativedelta(years=1)
+    cutoff = date_cursor + relativedelta(days=lead_days) - relativedelta(years=1)
+    next_term = Policy.__table__.alias('next_term')
+    has_next_term = exists().where(and_(next_term.c.policy_number == Policy.policy_number,
+                                        next_term.c.effective_date > Policy.effective_date))
+
+    renewed = 0
+    last_id = 0
+    while True:
+        policies = Policy.query.filter(Policy.status == u'Active')\
+                               .filter(Policy.effective_date >= earliest)\
+                               .filter(Policy.effective_date <= cutoff)\
+                               .filter(~has_next_term)\
+                               .filter(Policy.id > last_id)\
+                               .order_by(Policy.id)\
+                               .limit(batch_size)\
+                               .all()
+        if not policies:
+            break
+        last_id = policies[-1].id
+
+        try:
+            renewals = []
+            for policy in policies:
+                renewal = Policy(policy.policy_number,
+                                 policy.effective_date + relativedelta(years=1),
+                                 policy.annual_premium)
+                renewal.billing_schedule = policy.billing_schedule
+                renewal.named_insured = policy.named_insured
+                renewal.agent = policy.agent
+                renewals.append(renewal)
+            db.session.add_all(renewals)
+            # Flushing assigns the ids the invoices are inserted with.
+            db.session.flush()
+
+            rows = []
+            for renewal in renewals:
+                for invoice in PolicyAccounting.build_invoices(renewal):
+                    rows.append({'policy_id': invoice.policy_id,
+                                 'bill_date': invoice.bill_date,
+                                 'due_date': invoice.due_date,
+                                 'cancel_date': invoice.cancel_date,
+                                 'amount_due': invoice.amount_due,
+                                 'amount_remaining': invoice.amount_due,
+                                 'paid': invoice.amount_due <= 0})
+            db.session.execute(Invoice.__table__.insert(), rows)
+            db.session.commit()
+        except:
+            db.session.rollback()
+            raise
+
+        renewed += len(renewals)
+        logging.info("{} policies renewed ({} invoices).".format(renewed, len(rows)))
+
+    # The prior term stays in force until its year is over.
+    ended = Policy.query.filter(Policy.status == u'Active')\
+                        .filter(Policy.effective_date <= date_cursor - relativedelta(years=1))
+    lapsed = ended.filter(~has_next_term).count()
+    if lapsed:
+        logging.warning("{} policies lapsed without a renewal.".format(lapsed))
+    expired = ended.update({'status': u'Expired'}, synchronize_session=False)
+    db.session.commit()
+    logging.info("{} policies expired.".format(expired))
+
+    return renewed
 
 ################################
 # The functions below are for the db and
@@ -267,3 +477,4 @@ def insert_data():
     payment_for_p2 = Payment(p2.id, anna_white.id, 400, date(2015, 2, 1))
     db.session.add(payment_for_p2)
     db.session.commit()
+    PolicyAccounting(p2.id).allocate_payments()